@@ -11,8 +11,13 @@ from .core import (
     ExpertPersonaGenerator,
     PromptOptimizer,
     DynamicQueryHandler,
-    QueryHandlerSystem
+    QueryHandlerSystem,
+    PrefixCachingAdapter
 )
+from .admission import AdmissionController, AdmissionRejected
+from .recording import TrafficRecorder, load_trace
+from .adaptive import SLOController
+from .budget import count_tokens, compress_prompt
 
 __version__ = "0.1.0"
 __author__ = "Sulaiman Mutawalli"
@@ -23,5 +28,13 @@ __all__ = [
     "ExpertPersonaGenerator", 
     "PromptOptimizer",
     "DynamicQueryHandler",
-    "QueryHandlerSystem"
+    "QueryHandlerSystem",
+    "PrefixCachingAdapter",
+    "AdmissionController",
+    "AdmissionRejected",
+    "TrafficRecorder",
+    "load_trace",
+    "SLOController",
+    "count_tokens",
+    "compress_prompt"
 ]
@@ -0,0 +1,131 @@
+"""
+Adaptive SLO controller that switches pipeline modes based on observed latency
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Sequence
+from .core import PIPELINE_MODES
+
+class SLOController:
+    """Steps the pipeline down to cheaper modes when a p95 latency target is at risk
+
+    Latencies of recent ``process_query`` calls are kept in a rolling window per
+    mode. Once the current mode's window holds ``min_samples`` observations, the
+    controller steps one mode down when its p95 exceeds ``at_risk`` times the
+    target. It steps back up only when the next more expensive mode's own p95
+    is below ``recovered`` times the target, so a cheap mode being fast does not
+    by itself bring back a mode known to be too slow.
+
+    A mode's window expires once it has gone ``probe_interval`` seconds without
+    a sample, after which the controller probes it again. A probe that has to
+    step back down doubles that mode's interval, up to ``max_probe_interval``.
+    """
+
+    def __init__(
+        self,
+        target_p95: float,
+        modes: Sequence[str] = PIPELINE_MODES,
+        window: int = 50,
+        min_samples: int = 10,
+        at_risk: float = 0.9,
+        recovered: float = 0.5,
+        probe_interval: float = 60.0,
+        max_probe_interval: float = 600.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.target_p95 = target_p95
+        self.modes = tuple(modes)
+        self.min_samples = min_samples
+        self.at_risk = at_risk
+        self.recovered = recovered
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._windows = {mode: deque(maxlen=window) for mode in self.modes}
+        self._probe_intervals = {mode: probe_interval for mode in self.modes}
+        self._level = 0
+        self._probing = False
+        self._switches = 0
+
+    @property
+    def mode(self) -> str:
+        """Pipeline mode new requests should run in"""
+        return self.modes[self._level]
+
+    @property
+    def allowed_modes(self) -> Sequence[str]:
+        """Current mode followed by every cheaper one"""
+        return self.modes[self._level:]
+
+    def observe(self, latency: float, mode: Optional[str] = None):
+        """Record the latency of a request served in ``mode`` and adjust the current mode
+
+        ``mode`` defaults to the current mode. Latencies of modes the controller
+        does not manage, such as cached results, are ignored.
+        """
+        with self._lock:
+            mode = self.mode if mode is None else mode
+            if mode not in self._windows:
+                return
+            now = self.clock()
+            self._windows[mode].append((now, latency))
+            if mode != self.mode or len(self._windows[mode]) < self.min_samples:
+                return
+
+            p95 = self._percentile(mode)
+            if p95 > self.at_risk * self.target_p95:
+                if self._level < len(self.modes) - 1:
+                    if self._probing:
+                        self._probe_intervals[mode] = min(2 * self._probe_intervals[mode], self.max_probe_interval)
+                    self._switch(self._level + 1, probing=False)
+                return
+
+            self._probe_intervals[mode] = self.probe_interval
+            self._probing = False
+            if self._level == 0:
+                return
+            upper = self.modes[self._level - 1]
+            self._expire(upper, now)
+            estimate = self._percentile(upper)
+            if estimate is None:
+                self._switch(self._level - 1, probing=True)
+            elif estimate < self.recovered * self.target_p95:
+                self._switch(self._level - 1, probing=False)
+
+    def p95(self) -> Optional[float]:
+        """p95 latency of the current mode's window, or None before any observation"""
+        with self._lock:
+            return self._percentile(self.mode)
+
+    def stats(self) -> Dict:
+        """Current mode, per-mode window p95 and number of mode switches"""
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "target_p95": self.target_p95,
+                "p95": self._percentile(self.mode),
+                "samples": len(self._windows[self.mode]),
+                "mode_p95": {mode: self._percentile(mode) for mode in self.modes},
+                "switches": self._switches
+            }
+
+    def _switch(self, level: int, probing: bool):
+        self._level = level
+        self._probing = probing
+        self._switches += 1
+
+    def _expire(self, mode: str, now: float):
+        window = self._windows[mode]
+        if window and now - window[-1][0] > self._probe_intervals[mode]:
+            window.clear()
+
+    def _percentile(self, mode: str, fraction: float = 0.95) -> Optional[float]:
+        window = self._windows[mode]
+        if not window:
+            return None
+        ordered = sorted(latency for _, latency in window)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
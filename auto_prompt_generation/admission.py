@@ -0,0 +1,173 @@
+"""
+Deadline-aware admission control for QueryHandlerSystem
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+# Expected cost of each pipeline mode relative to "full", used for modes that
+# have not been measured yet. Roughly the share of LM work each mode keeps;
+# "template" makes no LM calls.
+DEFAULT_MODE_COSTS = {
+    "full": 1.0,
+    "no_reasoning": 0.6,
+    "cached_persona": 0.45,
+    "direct": 0.33,
+    "template": 0.0
+}
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of being queued"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request rejected: {reason}")
+        self.reason = reason
+
+class AdmissionController:
+    """Bounded, priority-ordered admission queue in front of the LM pipeline
+
+    Requests carry a deadline (seconds they are willing to wait for a result)
+    and a priority (higher runs first). Each request is admitted in the most
+    complete mode whose estimated queueing plus service time fits its deadline,
+    or rejected up front when none does or the queue is full.
+
+    Until a mode has been measured, its service time is estimated as its
+    ``mode_costs`` share of the "full" service time, so cheaper modes can be
+    chosen, and measured, before they have ever run.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        max_queue_depth: int = 16,
+        initial_service_time: float = 5.0,
+        smoothing: float = 0.2,
+        mode_costs: Optional[Dict[str, float]] = None
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.initial_service_time = initial_service_time
+        self.smoothing = smoothing
+        self.mode_costs = dict(DEFAULT_MODE_COSTS if mode_costs is None else mode_costs)
+
+        self._cond = threading.Condition()
+        self._waiting: List = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._service_times: Dict[str, float] = {}
+        self._counters = {"admitted": 0, "downgraded": 0, "shed": 0}
+
+    def service_time(self, mode: str) -> float:
+        """Smoothed observed duration of a request in the given mode, or its prior estimate"""
+        if mode in self._service_times:
+            return self._service_times[mode]
+        full = self._service_times.get("full", self.initial_service_time)
+        return self.mode_costs.get(mode, 1.0) * full
+
+    def estimated_wait(self, priority: int = 0) -> float:
+        """Estimated time a new request would spend queued before it runs"""
+        with self._cond:
+            return self._estimated_wait(priority)
+
+    def can_meet(self, deadline: Optional[float], priority: int = 0, mode: str = "full") -> bool:
+        """Whether a request in the given mode is expected to finish within its deadline"""
+        if deadline is None:
+            return True
+        with self._cond:
+            return self._estimated_wait(priority) + self.service_time(mode) <= deadline
+
+    def admit(
+        self,
+        deadline: Optional[float] = None,
+        priority: int = 0,
+        modes: Sequence[str] = ("full",)
+    ) -> str:
+        """Wait for a slot and return the most complete mode that fits the deadline
+
+        ``modes`` is ordered from most to least expensive. The mode is chosen
+        again when the request leaves the queue, against the time actually left.
+        Raises AdmissionRejected when the queue is full, no mode fits, or the
+        deadline passes while waiting. Every successful call must be paired with
+        ``release``.
+        """
+        start = time.monotonic()
+        with self._cond:
+            if len(self._waiting) >= self.max_queue_depth:
+                self._counters["shed"] += 1
+                raise AdmissionRejected("admission queue is full")
+
+            wait = self._estimated_wait(priority)
+            for mode in modes:
+                if deadline is None or wait + self.service_time(mode) <= deadline:
+                    break
+            else:
+                self._counters["shed"] += 1
+                raise AdmissionRejected("deadline cannot be met")
+
+            ticket = (-priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            while not (self._waiting[0] == ticket and self._active < self.max_concurrency):
+                remaining = None if deadline is None else deadline - (time.monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._counters["shed"] += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected("deadline expired while queued")
+                self._cond.wait(timeout=remaining)
+
+            heapq.heappop(self._waiting)
+            if deadline is not None:
+                # The wait may have run longer than estimated; re-pick the mode
+                remaining = deadline - (time.monotonic() - start)
+                mode = next((m for m in modes if self.service_time(m) <= remaining), None)
+                if mode is None:
+                    self._counters["shed"] += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected("deadline cannot be met after queueing")
+            self._active += 1
+            self._counters["admitted"] += 1
+            if mode != modes[0]:
+                self._counters["downgraded"] += 1
+            self._cond.notify_all()
+            return mode
+
+    def release(self, mode: str, duration: Optional[float] = None):
+        """Free the slot taken by ``admit`` and record how long the request ran
+
+        Pass no duration for failed requests so errors do not skew the estimate.
+        """
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+            if duration is None:
+                return
+            previous = self._service_times.get(mode)
+            if previous is None:
+                self._service_times[mode] = duration
+            else:
+                self._service_times[mode] = previous + self.smoothing * (duration - previous)
+
+    def record_downgrade(self):
+        """Count a request served from a cheaper path without taking a slot"""
+        with self._cond:
+            self._counters["downgraded"] += 1
+
+    def stats(self) -> Dict:
+        """Current queue depth, in-flight requests and admission counters"""
+        with self._cond:
+            return {
+                "queue_depth": len(self._waiting),
+                "active": self._active,
+                **self._counters
+            }
+
+    def _estimated_wait(self, priority: int) -> float:
+        ahead = sum(1 for waiting_priority, _ in self._waiting if -waiting_priority >= priority)
+        backlog = self._active + ahead - self.max_concurrency + 1
+        if backlog <= 0:
+            return 0.0
+        return backlog / self.max_concurrency * self.service_time("full")
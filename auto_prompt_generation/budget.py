@@ -0,0 +1,191 @@
+"""
+Prompt-length budgeting and deterministic compression of optimized prompts
+"""
+
+import re
+from typing import List, Optional, Set, Tuple
+
+# Word runs split into chunks of up to six characters, plus single punctuation
+# marks. Close to BPE token counts for English text without loading a tokenizer.
+_TOKEN_PATTERN = re.compile(r"\w{1,6}|[^\w\s]")
+# Units are lines, and sentences within a line. A sentence ends at punctuation
+# after a letter, so list markers such as "1." do not split a line.
+_UNIT_SEPARATOR_PATTERN = re.compile(r"(\s*\n\s*|(?<=[^\W\d][.!?])[ \t]+)")
+_QUERY_LABEL_PATTERN = re.compile(r"^\s*(?:user'?s? )?(?:question|query|request)\s*:\s*", re.IGNORECASE)
+_PERSONA_PATTERN = re.compile(
+    r"^(?:you are|you're|you have|you've|you bring|you possess|you specialize|you excel|"
+    r"your (?:background|experience|expertise)|as an? |with (?:over |more than )?\d|known for)",
+    re.IGNORECASE
+)
+
+def count_tokens(text: str) -> int:
+    """Fast local estimate of the number of LM tokens in text"""
+    return len(_TOKEN_PATTERN.findall(text))
+
+def _normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def _query_spans(text: str, user_query: str) -> List[Tuple[int, int]]:
+    """Character spans where text quotes the query verbatim, on word boundaries"""
+    query = user_query.strip()
+    if not query:
+        return []
+    return [match.span() for match in re.finditer(rf"(?<!\w){re.escape(query)}(?!\w)", text)]
+
+def _contains_query(text: str, user_query: str) -> bool:
+    return bool(_query_spans(text, user_query))
+
+def _split_paragraphs(prompt: str, user_query: str) -> List[str]:
+    """Split on blank lines, except inside a quoted query such as pasted code"""
+    spans = _query_spans(prompt, user_query)
+    paragraphs = []
+    start = 0
+    for separator in re.finditer(r"\n\s*\n", prompt):
+        if any(begin < separator.end() and separator.start() < end for begin, end in spans):
+            continue
+        paragraphs.append(prompt[start:separator.start()])
+        start = separator.end()
+    paragraphs.append(prompt[start:])
+    return [paragraph.strip() for paragraph in paragraphs if paragraph.strip()]
+
+def _is_query_block(paragraph: str, user_query: str) -> bool:
+    return _normalize(_QUERY_LABEL_PATTERN.sub("", paragraph)) == _normalize(user_query)
+
+class _Paragraph:
+    """A paragraph split into units, rebuilt from its original text on output"""
+
+    def __init__(self, text: str):
+        self.text = text
+        parts = _UNIT_SEPARATOR_PATTERN.split(text)
+        self.units = [(parts[i], parts[i + 1] if i + 1 < len(parts) else "") for i in range(0, len(parts), 2)]
+        self.offsets = [sum(len(part) for part in parts[:i]) for i in range(0, len(parts), 2)]
+        self.removed: Set[int] = set()
+
+    def overlapping(self, begin: int, end: int) -> Set[int]:
+        """Indices of the units that overlap the character span [begin, end)"""
+        return {
+            j for j, ((unit, _), offset) in enumerate(zip(self.units, self.offsets))
+            if offset < end and begin < offset + len(unit)
+        }
+
+    def render(self) -> str:
+        if not self.removed:
+            return self.text
+        pieces: List[str] = []
+        pending = ""
+        for index, (unit, separator) in enumerate(self.units):
+            if index in self.removed:
+                # Keep a line break that separated the removed unit from the next
+                if "\n" in separator and "\n" not in pending:
+                    pending = separator
+                continue
+            if pieces:
+                pieces.append(pending)
+            pieces.append(unit)
+            pending = separator
+        return "".join(pieces)
+
+def _render(paragraphs: List[_Paragraph]) -> str:
+    return "\n\n".join(text for text in (paragraph.render() for paragraph in paragraphs) if text)
+
+def _dedupe_query(paragraphs: List[str], user_query: str) -> List[str]:
+    """Drop repeated paragraphs that are nothing but the user's query
+
+    The last such block is kept unless the body quotes the query verbatim.
+    """
+    blocks = [i for i, paragraph in enumerate(paragraphs) if _is_query_block(paragraph, user_query)]
+    query_in_body = any(
+        _contains_query(paragraph, user_query)
+        for i, paragraph in enumerate(paragraphs)
+        if i not in blocks
+    )
+    keep = set() if query_in_body else set(blocks[-1:])
+    return [paragraph for i, paragraph in enumerate(paragraphs) if i not in blocks or i in keep]
+
+def _protected_units(paragraphs: List[_Paragraph], user_query: str) -> Set[Tuple[int, int]]:
+    """Units that must survive compression: the persona opening and the query"""
+    protected = set()
+    if paragraphs:
+        protected.add((0, 0))
+    for i, paragraph in enumerate(paragraphs):
+        if _is_query_block(paragraph.text, user_query):
+            protected.update((i, j) for j in range(len(paragraph.units)))
+            continue
+        for begin, end in _query_spans(paragraph.text, user_query):
+            protected.update((i, j) for j in paragraph.overlapping(begin, end))
+    return protected
+
+def _removal_order(
+    paragraphs: List[_Paragraph],
+    protected: Set[Tuple[int, int]]
+) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """Removable units, cheapest loss first, split into redundant and lossy removals
+
+    Exact repeats of an earlier unit go first, then the sentences describing
+    the persona after its opening, last first. The remaining instructions,
+    from the end of the prompt, are returned separately because removing them
+    loses content.
+    """
+    positions = [(i, j) for i, paragraph in enumerate(paragraphs) for j in range(len(paragraph.units))]
+
+    duplicates = []
+    seen = set()
+    for i, j in positions:
+        normalized = _normalize(paragraphs[i].units[j][0])
+        if normalized in seen and (i, j) not in protected:
+            duplicates.append((i, j))
+        elif normalized:
+            seen.add(normalized)
+
+    persona = []
+    if paragraphs and _PERSONA_PATTERN.match(paragraphs[0].units[0][0]):
+        for j in range(1, len(paragraphs[0].units)):
+            if not _PERSONA_PATTERN.match(paragraphs[0].units[j][0]):
+                break
+            if (0, j) not in protected and (0, j) not in duplicates:
+                persona.append((0, j))
+    persona.reverse()
+
+    chosen = set(duplicates) | set(persona)
+    trailing = [position for position in reversed(positions) if position not in protected and position not in chosen]
+    return duplicates + persona, trailing
+
+def compress_prompt(prompt: str, user_query: str, max_tokens: int) -> Tuple[str, int, int, bool]:
+    """Deterministically shrink a prompt towards a token budget
+
+    Repeated query blocks are dropped first. Then single sentences or lines
+    are removed one at a time until the prompt fits: exact repeats of earlier
+    instructions, then persona description after the opening "You are ..."
+    sentence, then, as a last resort, trailing instructions. Paragraphs that
+    lose nothing keep their original text. The persona opening and every unit
+    overlapping the user's query are never removed, so the result may still
+    exceed a budget smaller than those.
+
+    Returns the compressed prompt, its token counts before and after, and
+    whether instructions were truncated rather than only deduplicated or
+    trimmed from the persona.
+    """
+    before = count_tokens(prompt)
+    if before <= max_tokens:
+        return prompt, before, before, False
+
+    paragraphs = [_Paragraph(text) for text in _dedupe_query(_split_paragraphs(prompt, user_query), user_query)]
+    compressed = _render(paragraphs)
+
+    redundant, lossy = _removal_order(paragraphs, _protected_units(paragraphs, user_query))
+    truncated = False
+    for index, (i, j) in enumerate(redundant + lossy):
+        if count_tokens(compressed) <= max_tokens:
+            break
+        paragraphs[i].removed.add(j)
+        compressed = _render(paragraphs)
+        truncated = index >= len(redundant)
+
+    return compressed, before, count_tokens(compressed), truncated
+
+def apply_budget(prompt: str, user_query: str, max_tokens: Optional[int]) -> Tuple[str, int, int, bool]:
+    """Compress a prompt if a budget is set, and report token counts and truncation"""
+    if max_tokens is None:
+        tokens = count_tokens(prompt)
+        return prompt, tokens, tokens, False
+    return compress_prompt(prompt, user_query, max_tokens)
@@ -23,6 +23,13 @@ def main():
         help="Model to use for processing (default: ollama_chat/gemma2:2b)"
     )
     
+    parser.add_argument(
+        "--max-prompt-tokens",
+        type=int,
+        default=None,
+        help="Token budget for the optimized prompt; longer prompts are compressed (default: no limit)"
+    )
+    
     parser.add_argument(
         "--output-format",
         choices=["json", "text"],
@@ -39,7 +46,10 @@ def main():
     args = parser.parse_args()
     
     # Initialize the system
-    system = QueryHandlerSystem(model_name=args.model)
+    options = {}
+    if args.max_prompt_tokens is not None:
+        options["max_prompt_tokens"] = args.max_prompt_tokens
+    system = QueryHandlerSystem(model_name=args.model, **options)
     
     # Process the query
     result = system.process_query(args.query)
@@ -50,6 +60,9 @@ def main():
         print(f"Original Query: {result['original_query']}")
         if args.verbose:
             print(f"Analysis: {result['analysis']}")
+            tokens = result["prompt_tokens"]
+            truncated = " (instructions truncated)" if tokens.get("truncated") else ""
+            print(f"Prompt Tokens: {tokens['before']} -> {tokens['after']}{truncated}")
         print(f"Optimized Prompt: {result['optimized_prompt']}")
 
 if __name__ == "__main__":
@@ -1,5 +1,76 @@
+import os
+import textwrap
+import threading
+import time
+from collections import OrderedDict
 import dspy
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, Optional
+from .admission import AdmissionController, AdmissionRejected
+from .budget import apply_budget
+from .recording import TrafficRecorder
+
+if TYPE_CHECKING:
+    from .adaptive import SLOController
+
+SYSTEM_INSTRUCTION = textwrap.dedent("""
+    IMPORTANT: You are creating PROMPTS for another AI system, not answering the user's question directly.
+    Your output should be a complete prompt that starts with "You are [expert role]..." and ends with the user's original question.
+    The prompt should instruct another AI on how to respond to the user's query.
+    DO NOT answer the user's question - CREATE A PROMPT for another AI to answer it.
+""").strip()
+
+# Pipeline modes, from most to least expensive. Each mode keeps the savings of the
+# previous ones: "no_reasoning" drops the chain-of-thought step from every stage,
+# "cached_persona" reuses the persona last generated for the same classification,
+# "direct" runs only the prompt optimizer with a generic persona and "template"
+# makes no LM calls at all.
+PIPELINE_MODES = ("full", "no_reasoning", "cached_persona", "direct", "template")
+
+GENERIC_CLASSIFICATION = {
+    "query_type": "informational",
+    "domain": "general",
+    "complexity": "moderate",
+    "intent": "Get a helpful, accurate answer to the question"
+}
+
+GENERIC_PERSONA = {
+    "expert_role": "a knowledgeable expert assistant",
+    "expertise_description": "Broad expertise across domains and a clear, structured communication style"
+}
+
+TEMPLATE_PROMPT = (
+    "You are {expert_role}. {expertise_description}. "
+    "Answer the user's question accurately and completely, explain your reasoning "
+    "where it helps, and state any assumptions you make."
+    "\n\nUser's question: {user_query}"
+)
+
+class LRUCache(OrderedDict):
+    """Thread-safe dictionary that evicts the least recently used entry beyond max_size"""
+    
+    def __init__(self, max_size: int = 256):
+        super().__init__()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+    
+    def __getitem__(self, key):
+        with self._lock:
+            value = super().__getitem__(key)
+            self.move_to_end(key)
+            return value
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.max_size:
+                self.popitem(last=False)
 
 class QueryClassifier(dspy.Signature):
     """Classify the type of user query and determine appropriate handling strategy"""
@@ -29,10 +100,36 @@ class PromptOptimizer(dspy.Signature):
     intent = dspy.InputField()
     optimized_prompt = dspy.OutputField(desc="A complete prompt instruction that starts with 'You are [expert role]...' and includes the original query at the end. This should be a prompt TO SEND TO an AI system, not an answer to the query.")
 
+class PrefixCachingAdapter(dspy.ChatAdapter):
+    """Chat adapter that leads every stage prompt with the same static preamble
+
+    The rendered messages are ordered from most to least stable: the shared
+    preamble, the signature instructions, the few-shot demos and only then the
+    per-query inputs. Backends with prefix caching (Ollama, vLLM) can then reuse
+    the KV cache for everything before the user's query.
+    """
+    
+    def __init__(self, preamble: str, callbacks=None):
+        super().__init__(callbacks=callbacks)
+        self.preamble = preamble
+    
+    def format(self, signature, demos, inputs):
+        messages = super().format(signature, demos, inputs)
+        messages[0] = {
+            "role": messages[0]["role"],
+            "content": f"{self.preamble}\n\n{messages[0]['content']}"
+        }
+        return messages
+
+    def parse(self, signature, completion, _parse_values=True):
+        # Defined explicitly so Adapter.__init_subclass__ wraps this method rather
+        # than re-wrapping the inherited one, which breaks when callbacks are set
+        return super().parse(signature, completion, _parse_values=_parse_values)
+
 class DynamicQueryHandler(dspy.Module):
     """Main module that handles any type of user query and generates optimized prompts"""
     
-    def __init__(self):
+    def __init__(self, max_prompt_tokens: Optional[int] = None, cache_size: int = 256):
         super().__init__()
         
         # Initialize the pipeline components with more specific instructions
@@ -40,74 +137,238 @@ class DynamicQueryHandler(dspy.Module):
         self.persona_generator = dspy.ChainOfThought(ExpertPersonaGenerator)
         self.prompt_optimizer = dspy.ChainOfThought(PromptOptimizer)
         
-        # Add system instruction for prompt generation
-        self.system_instruction = """
-        IMPORTANT: You are creating PROMPTS for another AI system, not answering the user's question directly.
-        Your output should be a complete prompt that starts with "You are [expert role]..." and ends with the user's original question.
-        The prompt should instruct another AI on how to respond to the user's query.
-        DO NOT answer the user's question - CREATE A PROMPT for another AI to answer it.
-        """
+        # Add system instruction for prompt generation, shared as the static
+        # prefix of every stage prompt
+        self.system_instruction = SYSTEM_INSTRUCTION
+        self.adapter = PrefixCachingAdapter(self.system_instruction)
         
         # Cache for common query patterns (optional optimization)
-        self.query_cache = {}
+        self.query_cache = LRUCache(cache_size)
+        
+        # Personas keyed by (query_type, domain, complexity) for cached_persona mode
+        self.persona_cache = LRUCache(cache_size)
+        
+        # Optional token budget for the optimized prompt; longer prompts are compressed
+        self.max_prompt_tokens = max_prompt_tokens
+    
+    def stages(self) -> Dict[str, dspy.Module]:
+        """Pipeline stages in execution order"""
+        return {
+            "classifier": self.classifier,
+            "persona_generator": self.persona_generator,
+            "prompt_optimizer": self.prompt_optimizer
+        }
     
-    def forward(self, user_query: str) -> dspy.Prediction:
+    def shared_prefix_lengths(self) -> Dict[str, int]:
+        """Report how many characters of each stage prompt are query-independent
+        
+        Each stage is rendered twice with different placeholder inputs; the
+        length of the common prefix is what a prefix cache can reuse per call.
+        """
+        lengths = {}
+        for name, stage in self.stages().items():
+            predictor = stage.predictors()[0]
+            rendered = []
+            for variant in ("a", "b"):
+                inputs = {field: f"<{field}-{variant}>" for field in predictor.signature.input_fields}
+                messages = self.adapter.format(predictor.signature, predictor.demos, inputs)
+                rendered.append("".join(f"{m['role']}: {m['content']}\n" for m in messages))
+            lengths[name] = len(os.path.commonprefix(rendered))
+        return lengths
+    
+    def forward(self, user_query: str, mode: str = "full") -> dspy.Prediction:
         """Process any user query and return optimized prompt"""
         
-        # Step 1: Classify the query
-        classification = self.classifier(query=user_query)
+        if mode not in PIPELINE_MODES:
+            raise ValueError(f"Unknown pipeline mode: {mode}")
         
-        # Step 2: Generate appropriate expert persona
-        persona = self.persona_generator(
-            query_type=classification.query_type,
-            domain=classification.domain,
-            complexity=classification.complexity
-        )
+        with dspy.context(adapter=self.adapter):
+            result = self._run_pipeline(user_query, mode)
         
-        # Step 3: Create optimized prompt with explicit instruction
-        optimized = self.prompt_optimizer(
-            original_query=user_query,
-            expert_role=persona.expert_role,
-            expertise_description=persona.expertise_description,
-            query_type=classification.query_type,
-            intent=classification.intent
-        )
+        if mode == "full":
+            self.query_cache[user_query] = result
+        return result
+    
+    def _run_pipeline(self, user_query: str, mode: str = "full") -> dspy.Prediction:
+        """Run the pipeline stages for a single query"""
+        
+        if mode in ("direct", "template"):
+            classification = dspy.Prediction(**GENERIC_CLASSIFICATION)
+            persona = dspy.Prediction(**GENERIC_PERSONA)
+        else:
+            # Step 1: Classify the query
+            classification = self.classifier(
+                query=user_query,
+                **self._stage_options(self.classifier, mode)
+            )
+            
+            # Step 2: Generate appropriate expert persona, or reuse a cached one
+            persona_key = (classification.query_type, classification.domain, classification.complexity)
+            persona = self.persona_cache.get(persona_key) if mode == "cached_persona" else None
+            if persona is None:
+                persona = self.persona_generator(
+                    query_type=classification.query_type,
+                    domain=classification.domain,
+                    complexity=classification.complexity,
+                    **self._stage_options(self.persona_generator, mode)
+                )
+                self.persona_cache[persona_key] = persona
+        
+        if mode == "template":
+            prompt_text = TEMPLATE_PROMPT.format(
+                expert_role=persona.expert_role,
+                expertise_description=persona.expertise_description,
+                user_query=user_query
+            )
+        else:
+            # Step 3: Create optimized prompt with explicit instruction
+            optimized = self.prompt_optimizer(
+                original_query=user_query,
+                expert_role=persona.expert_role,
+                expertise_description=persona.expertise_description,
+                query_type=classification.query_type,
+                intent=classification.intent,
+                **self._stage_options(self.prompt_optimizer, mode)
+            )
+            prompt_text = optimized.optimized_prompt
         
         # Post-process to ensure it's a proper prompt format
-        prompt_text = optimized.optimized_prompt
         if not prompt_text.startswith("You are"):
             prompt_text = f"You are {persona.expert_role}. {prompt_text}"
         
         if user_query not in prompt_text:
             prompt_text += f"\n\nUser's question: {user_query}"
         
+        prompt_text, original_tokens, prompt_tokens, truncated = apply_budget(
+            prompt_text, user_query, self.max_prompt_tokens
+        )
+        
         return dspy.Prediction(
             original_query=user_query,
             query_type=classification.query_type,
             domain=classification.domain,
             complexity=classification.complexity,
             expert_role=persona.expert_role,
-            optimized_prompt=prompt_text
+            optimized_prompt=prompt_text,
+            original_prompt_tokens=original_tokens,
+            prompt_tokens=prompt_tokens,
+            prompt_truncated=truncated
         )
 
+    def _stage_options(self, stage: dspy.Module, mode: str) -> Dict:
+        """Extra stage arguments for the mode; outside full mode reasoning is skipped"""
+        
+        if mode == "full":
+            return {}
+        return {"new_signature": stage.signature}
+
 class QueryHandlerSystem:
     """Complete system for handling diverse user queries"""
     
-    def __init__(self, model_name: str = "ollama_chat/gemma2:2b"):
-        # Configure DSPy with your preferred LM
-        dspy.settings.configure(lm=dspy.LM(model=model_name))
+    def __init__(
+        self,
+        model_name: str = "ollama_chat/gemma2:2b",
+        admission: Optional[AdmissionController] = None,
+        recorder: Optional[TrafficRecorder] = None,
+        lm: Optional[dspy.LM] = None,
+        slo: Optional["SLOController"] = None,
+        max_prompt_tokens: Optional[int] = None,
+        cache_size: int = 256
+    ):
+        # Configure DSPy with your preferred LM; an explicit lm overrides model_name
+        dspy.settings.configure(lm=lm if lm is not None else dspy.LM(model=model_name))
         
         # Initialize the main handler
-        self.handler = DynamicQueryHandler()
+        self.handler = DynamicQueryHandler(max_prompt_tokens=max_prompt_tokens, cache_size=cache_size)
+        
+        # Optional traffic recording of every process_query call
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.track(self.handler)
+        
+        # Optional admission control; without it every call runs the full pipeline
+        self.admission = admission
+        
+        # Optional SLO controller choosing the pipeline mode from observed latency
+        self.slo = slo
         
         # # Optional: Compile with examples for better performance
         # self.compiled_handler = None
     
-    def process_query(self, user_query: str) -> Dict:
-        """Main entry point - processes any user query"""
+    def process_query(
+        self,
+        user_query: str,
+        deadline: Optional[float] = None,
+        priority: int = 0
+    ) -> Dict:
+        """Main entry point - processes any user query
+        
+        With admission control enabled, ``deadline`` is the number of seconds the
+        caller is willing to wait and ``priority`` orders queued requests (higher
+        first). Requests that cannot finish in time are served from the query
+        cache or a cheaper pipeline mode, or rejected with AdmissionRejected.
+        
+        With an SLO controller, the pipeline runs in the controller's current
+        mode and the call's latency is fed back to it, except for cached results.
+        """
+        
+        if self.recorder is None:
+            return self._observe(user_query, deadline, priority)
+        
+        # Record from arrival, so queueing, shed and cached requests are all traced
+        self.recorder.start(user_query, deadline, priority)
+        try:
+            with dspy.context(callbacks=[*dspy.settings.get("callbacks", []), self.recorder]):
+                result = self._observe(user_query, deadline, priority)
+        except AdmissionRejected as exc:
+            self.recorder.finish(rejected=exc.reason)
+            raise
+        except Exception as exc:
+            self.recorder.finish(error=repr(exc))
+            raise
+        self.recorder.finish(mode=result["mode"])
+        return result
+    
+    def _observe(self, user_query: str, deadline: Optional[float], priority: int) -> Dict:
+        """Dispatch the query and feed its latency to the SLO controller"""
         
-        handler = self.handler
-        result = handler(user_query)
+        start = time.monotonic()
+        result = self._dispatch(user_query, deadline, priority)
+        if self.slo is not None and result["mode"] != "cached":
+            self.slo.observe(time.monotonic() - start, result["mode"])
+        return result
+    
+    def _dispatch(self, user_query: str, deadline: Optional[float], priority: int) -> Dict:
+        """Pick a pipeline mode for the query and run it"""
+        
+        modes = PIPELINE_MODES if self.slo is None else self.slo.allowed_modes
+        
+        # A cached full result beats any degraded mode
+        cached = self.handler.query_cache.get(user_query)
+        if cached is not None:
+            degraded = modes[0] != "full"
+            if self.admission is not None and not self.admission.can_meet(deadline, priority, modes[0]):
+                degraded = True
+            if degraded:
+                if self.admission is not None:
+                    self.admission.record_downgrade()
+                return self._format_result(cached, "cached")
+        
+        if self.admission is None:
+            return self._format_result(self.handler(user_query, mode=modes[0]), modes[0])
+        
+        mode = self.admission.admit(deadline, priority, modes=modes)
+        start = time.monotonic()
+        try:
+            result = self.handler(user_query, mode=mode)
+        except Exception:
+            self.admission.release(mode)
+            raise
+        self.admission.release(mode, time.monotonic() - start)
+        return self._format_result(result, mode)
+    
+    def _format_result(self, result: dspy.Prediction, mode: str) -> Dict:
+        """Convert a handler prediction into the public result dictionary"""
         
         return {
             "original_query": result.original_query,
@@ -117,5 +378,11 @@ class QueryHandlerSystem:
                 "complexity": result.complexity,
                 "expert_role": result.expert_role
             },
-            "optimized_prompt": result.optimized_prompt
+            "optimized_prompt": result.optimized_prompt,
+            "prompt_tokens": {
+                "before": result.original_prompt_tokens,
+                "after": result.prompt_tokens,
+                "truncated": result.prompt_truncated
+            },
+            "mode": mode
         }
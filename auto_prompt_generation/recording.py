@@ -0,0 +1,104 @@
+"""
+Opt-in traffic recorder for QueryHandlerSystem
+"""
+
+import json
+import threading
+import time
+from typing import Dict, List, Optional
+import dspy
+from dspy.utils.callback import BaseCallback
+
+class TrafficRecorder(BaseCallback):
+    """DSPy callback that appends every processed query to a JSON Lines trace
+
+    QueryHandlerSystem opens a record when a request arrives, before admission
+    control, and closes it with the outcome: the mode that served it, or why it
+    was rejected or failed. Each line holds the arrival time, query, deadline,
+    priority, outcome and total duration, plus every LM call the request made
+    with the stage that issued it, the rendered messages, the raw outputs and
+    the call latency. The trace can be re-driven with
+    ``auto_prompt_generation.replay``.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._stages: Dict[int, str] = {}
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def track(self, handler: dspy.Module):
+        """Attribute LM calls made by the given DynamicQueryHandler's stages"""
+        self._stages.update({id(stage): name for name, stage in handler.stages().items()})
+
+    def start(self, query: str, deadline: Optional[float] = None, priority: int = 0):
+        """Open the record for a request arriving on the current thread"""
+        state = self._local
+        state.record = {
+            "time": time.time(),
+            "query": query,
+            "deadline": deadline,
+            "priority": priority,
+            "calls": []
+        }
+        state.started = time.monotonic()
+        state.stage = None
+        state.stage_call_id = None
+        state.lm_calls = {}
+
+    def finish(self, mode: Optional[str] = None, rejected: Optional[str] = None, error: Optional[str] = None):
+        """Close the current thread's record with its outcome and append it to the trace"""
+        state = self._local
+        record = getattr(state, "record", None)
+        if record is None:
+            return
+        state.record = None
+        record["duration"] = time.monotonic() - state.started
+        record["mode"] = mode
+        if rejected is not None:
+            record["rejected"] = rejected
+        if error is not None:
+            record["error"] = error
+        self._write(record)
+
+    def on_module_start(self, call_id, instance, inputs):
+        state = self._local
+        if getattr(state, "record", None) is not None and id(instance) in self._stages:
+            state.stage = self._stages[id(instance)]
+            state.stage_call_id = call_id
+
+    def on_module_end(self, call_id, outputs, exception=None):
+        state = self._local
+        if getattr(state, "record", None) is not None and call_id == state.stage_call_id:
+            state.stage = None
+            state.stage_call_id = None
+
+    def on_lm_start(self, call_id, instance, inputs):
+        state = self._local
+        if getattr(state, "record", None) is None:
+            return
+        messages = inputs.get("messages") or [{"role": "user", "content": inputs.get("prompt")}]
+        state.lm_calls[call_id] = ({"stage": state.stage, "messages": messages}, time.monotonic())
+
+    def on_lm_end(self, call_id, outputs, exception=None):
+        state = self._local
+        if getattr(state, "record", None) is None or call_id not in state.lm_calls:
+            return
+        call, started = state.lm_calls.pop(call_id)
+        call["outputs"] = outputs
+        call["latency"] = time.monotonic() - started
+        if exception is not None:
+            call["error"] = repr(exception)
+        state.record["calls"].append(call)
+
+    def _write(self, record: Dict):
+        line = json.dumps(record, separators=(",", ":"), default=str)
+        with self._write_lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+def load_trace(path: str) -> List[Dict]:
+    """Read a trace written by TrafficRecorder, ordered by arrival time"""
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record["time"])
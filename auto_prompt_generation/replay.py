@@ -0,0 +1,218 @@
+"""
+Deterministic replay of recorded traffic for load testing
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import dspy
+from dspy.utils.callback import with_callbacks
+from .admission import AdmissionController, AdmissionRejected
+from .core import QueryHandlerSystem
+from .recording import load_trace
+
+def _messages_key(messages) -> str:
+    return json.dumps(messages, sort_keys=True, default=str)
+
+class ReplayLM(dspy.LM):
+    """Stand-in LM that serves recorded responses with the recorded latencies
+
+    Calls are matched on their exact rendered messages. When a prompt changed
+    since recording, a response recorded for the same system message (i.e. the
+    same stage) and the same query is served instead; the query is the longest
+    recorded one quoted in the call's last message. Responses recorded more than
+    once for the same key are served in rotation, so concurrent calls with the
+    same key may get them in a different order from run to run.
+    """
+
+    def __init__(self, records: List[Dict], speed: float = 1.0):
+        super().__init__(model="replay")
+        self.speed = speed
+        self._exact = defaultdict(deque)
+        self._by_stage = defaultdict(deque)
+        self._queries = defaultdict(set)
+        self._lock = threading.Lock()
+        for record in records:
+            for call in record.get("calls", []):
+                if "outputs" not in call:
+                    continue
+                response = (call["outputs"], call.get("latency", 0.0))
+                system_key = _messages_key(call["messages"][:1])
+                self._exact[_messages_key(call["messages"])].append(response)
+                self._by_stage[(system_key, record["query"])].append(response)
+                self._queries[system_key].add(record["query"])
+
+    @with_callbacks
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        messages = messages or [{"role": "user", "content": prompt}]
+        outputs, latency = self._next_response(messages)
+        time.sleep(latency / self.speed)
+        return outputs
+
+    def _next_response(self, messages):
+        with self._lock:
+            for index, key in ((self._exact, _messages_key(messages)), (self._by_stage, self._stage_key(messages))):
+                responses = index.get(key)
+                if responses:
+                    # Rotate so repeated prompts cycle through their recordings
+                    responses.rotate(-1)
+                    return responses[-1]
+        raise LookupError("No recorded response matches this prompt")
+
+    def _stage_key(self, messages):
+        system_key = _messages_key(messages[:1])
+        content = str(messages[-1].get("content", ""))
+        quoted = [query for query in self._queries.get(system_key, ()) if query in content]
+        if not quoted:
+            return None
+        return system_key, max(quoted, key=lambda query: (len(query), query))
+
+def replay(
+    records: List[Dict],
+    system: QueryHandlerSystem,
+    speed: float = 1.0,
+    max_workers: int = 8
+) -> List[Dict]:
+    """Re-drive recorded queries against a system at original or scaled speed
+
+    Requests are issued open-loop at their recorded arrival offsets divided by
+    ``speed``, so slow responses do not delay later arrivals. Durations are
+    measured from each request's scheduled arrival, so time spent waiting for
+    one of the ``max_workers`` threads counts as latency. Each request keeps its
+    recorded priority and deadline (divided by ``speed``), less that wait; a
+    request whose deadline passes before it is dispatched is rejected.
+    """
+    if not records:
+        return []
+
+    results: List[Optional[Dict]] = [None] * len(records)
+
+    def run(index: int, record: Dict, arrival: float):
+        outcome = {
+            "query": record["query"],
+            "recorded_mode": record.get("mode"),
+            "recorded_duration": record.get("duration")
+        }
+        deadline = record.get("deadline")
+        remaining = None if deadline is None else deadline / speed - (time.monotonic() - arrival)
+        try:
+            if remaining is not None and remaining <= 0:
+                raise AdmissionRejected("deadline expired before dispatch")
+            outcome["mode"] = system.process_query(
+                record["query"],
+                deadline=remaining,
+                priority=record.get("priority", 0)
+            ).get("mode")
+        except AdmissionRejected as exc:
+            outcome["rejected"] = exc.reason
+        except Exception as exc:
+            outcome["error"] = repr(exc)
+        outcome["duration"] = time.monotonic() - arrival
+        results[index] = outcome
+
+    origin = records[0]["time"]
+    replay_start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, record in enumerate(records):
+            arrival = replay_start + (record["time"] - origin) / speed
+            delay = arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, index, record, arrival)
+
+    return results
+
+def summarize(results: List[Dict]) -> Dict:
+    """Latency percentiles and rejection and error counts for a replay run"""
+    durations = sorted(
+        result["duration"] for result in results
+        if "error" not in result and "rejected" not in result
+    )
+
+    def percentile(fraction: float) -> Optional[float]:
+        if not durations:
+            return None
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+    return {
+        "requests": len(results),
+        "rejected": sum(1 for result in results if "rejected" in result),
+        "errors": sum(1 for result in results if "error" in result),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": durations[-1] if durations else None
+    }
+
+def main():
+    """Replay CLI entry point"""
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded traffic trace against QueryHandlerSystem"
+    )
+
+    parser.add_argument(
+        "trace",
+        help="Trace file written by TrafficRecorder"
+    )
+
+    parser.add_argument(
+        "--model",
+        default="ollama_chat/gemma2:2b",
+        help="Live model to replay against (default: ollama_chat/gemma2:2b)"
+    )
+
+    parser.add_argument(
+        "--stand-in",
+        action="store_true",
+        help="Serve recorded LM responses with recorded latencies instead of a live model"
+    )
+
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Arrival and stand-in latency speed-up factor (default: 1.0)"
+    )
+
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=8,
+        help="Maximum concurrent in-flight requests; later arrivals wait, and the wait counts as latency (default: 8)"
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Put an admission controller with this many slots in front of the system (default: none)"
+    )
+
+    parser.add_argument(
+        "--output-format",
+        choices=["json", "text"],
+        default="text",
+        help="Output format (default: text)"
+    )
+
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    lm = ReplayLM(records, speed=args.speed) if args.stand_in else None
+    admission = None if args.max_concurrency is None else AdmissionController(max_concurrency=args.max_concurrency)
+    system = QueryHandlerSystem(model_name=args.model, lm=lm, admission=admission)
+
+    summary = summarize(replay(records, system, speed=args.speed, max_workers=args.max_workers))
+
+    if args.output_format == "json":
+        print(json.dumps(summary, indent=2))
+    else:
+        for key, value in summary.items():
+            print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -58,6 +58,7 @@ setup(
     entry_points={
         "console_scripts": [
             "auto-prompt-gen=auto_prompt_generation.cli:main",
+            "auto-prompt-replay=auto_prompt_generation.replay:main",
         ],
     },
     keywords="dspy, prompt, generation, ai, nlp, optimization",
@@ -0,0 +1,165 @@
+"""
+Tests for the adaptive SLO controller
+"""
+
+from unittest.mock import Mock
+from auto_prompt_generation.adaptive import SLOController
+from auto_prompt_generation.core import PIPELINE_MODES, QueryHandlerSystem
+
+class TestSLOController:
+    """Test mode switching in SLOController"""
+    
+    def test_starts_in_full_mode(self):
+        """Test that the controller starts with the most complete mode"""
+        controller = SLOController(target_p95=2.0)
+        assert controller.mode == "full"
+        assert tuple(controller.allowed_modes) == PIPELINE_MODES
+    
+    def test_waits_for_min_samples(self):
+        """Test that no decision is made before the window has enough samples"""
+        controller = SLOController(target_p95=2.0, min_samples=5)
+        for _ in range(4):
+            controller.observe(10.0)
+        assert controller.mode == "full"
+    
+    def test_steps_down_when_target_at_risk(self):
+        """Test that a slow window steps down one mode"""
+        controller = SLOController(target_p95=2.0, min_samples=5)
+        for _ in range(5):
+            controller.observe(10.0)
+        
+        assert controller.mode == "no_reasoning"
+        stats = controller.stats()
+        assert stats["samples"] == 0
+        assert stats["switches"] == 1
+    
+    def test_steps_back_up_when_upper_mode_is_fast(self):
+        """Test that the controller steps up when the more expensive mode's estimate fits"""
+        controller = SLOController(target_p95=2.0, min_samples=5, window=5)
+        for _ in range(5):
+            controller.observe(10.0)
+        assert controller.mode == "no_reasoning"
+        
+        # Fresh fast samples for full (e.g. from requests already in flight)
+        # replace the slow ones in its window
+        for _ in range(5):
+            controller.observe(0.5, mode="full")
+        for _ in range(5):
+            controller.observe(0.1)
+        assert controller.mode == "full"
+    
+    def test_does_not_step_up_into_known_slow_mode(self):
+        """Test that a fast cheap mode alone does not bring back a slow mode"""
+        controller = SLOController(target_p95=2.0, min_samples=5)
+        for _ in range(5):
+            controller.observe(10.0)
+        for _ in range(20):
+            controller.observe(0.1)
+        assert controller.mode == "no_reasoning"
+    
+    def test_probes_upper_mode_once_its_window_expires(self):
+        """Test that a stale upper mode is probed again and backs off if still slow"""
+        now = [0.0]
+        controller = SLOController(target_p95=2.0, min_samples=1, probe_interval=60.0, clock=lambda: now[0])
+        controller.observe(10.0)
+        assert controller.mode == "no_reasoning"
+        
+        now[0] = 61.0
+        controller.observe(0.1)
+        assert controller.mode == "full"
+        
+        # The probe is still slow: step down and wait twice as long next time
+        controller.observe(10.0)
+        assert controller.mode == "no_reasoning"
+        now[0] = 61.0 + 90.0
+        controller.observe(0.1)
+        assert controller.mode == "no_reasoning"
+        now[0] = 61.0 + 121.0
+        controller.observe(0.1)
+        assert controller.mode == "full"
+    
+    def test_holds_slo_under_steady_overload(self):
+        """Test that steady overload settles on a fitting mode instead of flapping"""
+        now = [0.0]
+        latencies = {"full": 10.0, "direct": 3.0, "template": 0.01}
+        controller = SLOController(
+            target_p95=2.0,
+            modes=("full", "direct", "template"),
+            clock=lambda: now[0]
+        )
+        
+        observed = []
+        for _ in range(2000):
+            latency = latencies[controller.mode]
+            now[0] += latency
+            controller.observe(latency)
+            observed.append(latency)
+        
+        over_target = sum(1 for latency in observed if latency > 2.0)
+        assert controller.mode == "template"
+        assert controller.stats()["switches"] <= 4
+        assert over_target / len(observed) < 0.05
+        assert sorted(observed)[int(0.95 * len(observed))] <= 2.0
+    
+    def test_holds_within_band(self):
+        """Test that latencies between the thresholds keep the current mode"""
+        controller = SLOController(target_p95=2.0, min_samples=5)
+        for _ in range(20):
+            controller.observe(1.5)
+        assert controller.mode == "full"
+        assert controller.p95() == 1.5
+    
+    def test_stops_at_cheapest_mode(self):
+        """Test that the controller never steps past the last mode"""
+        controller = SLOController(target_p95=2.0, min_samples=1)
+        for _ in range(20):
+            controller.observe(10.0)
+        assert controller.mode == "template"
+
+class TestQueryHandlerSystemSLO:
+    """Test QueryHandlerSystem driven by an SLO controller"""
+    
+    def make_system(self, controller):
+        """Build a system with a mocked handler"""
+        system = QueryHandlerSystem(model_name="test_model", slo=controller)
+        system.handler = Mock(query_cache={}, return_value=Mock(
+            original_query="test query",
+            query_type="technical",
+            domain="technology",
+            complexity="moderate",
+            expert_role="software engineer",
+            optimized_prompt="You are a software engineer..."
+        ))
+        return system
+    
+    def test_runs_in_controller_mode(self):
+        """Test that results are tagged with the controller's mode"""
+        controller = SLOController(target_p95=2.0, min_samples=1)
+        controller.observe(10.0)
+        system = self.make_system(controller)
+        
+        result = system.process_query("test query")
+        
+        assert result["mode"] == "no_reasoning"
+        system.handler.assert_called_once_with("test query", mode="no_reasoning")
+        
+        # The fast call is recorded against its own mode; full is still known slow
+        assert controller.stats()["mode_p95"]["no_reasoning"] is not None
+        assert controller.mode == "no_reasoning"
+    
+    def test_prefers_cached_result_when_degraded(self):
+        """Test that a cached result is served instead of a degraded mode"""
+        controller = SLOController(target_p95=2.0, min_samples=1)
+        controller.observe(10.0)
+        system = self.make_system(controller)
+        system.handler.query_cache["test query"] = system.handler.return_value
+        
+        result = system.process_query("test query")
+        
+        assert result["mode"] == "cached"
+        system.handler.assert_not_called()
+        
+        # Cached hits do not pull the latency windows down
+        assert controller.stats()["mode_p95"] == {
+            "full": 10.0, "no_reasoning": None, "cached_persona": None, "direct": None, "template": None
+        }
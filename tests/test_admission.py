@@ -0,0 +1,170 @@
+"""
+Tests for deadline-aware admission control
+"""
+
+import threading
+import time
+import pytest
+from unittest.mock import Mock
+from auto_prompt_generation.admission import AdmissionController, AdmissionRejected
+from auto_prompt_generation.core import PIPELINE_MODES, QueryHandlerSystem
+
+def make_result(query="test query"):
+    """Build a handler result for the given query"""
+    return Mock(
+        original_query=query,
+        query_type="technical",
+        domain="technology",
+        complexity="moderate",
+        expert_role="software engineer",
+        optimized_prompt="You are a software engineer..."
+    )
+
+class TestAdmissionController:
+    """Test the AdmissionController queue"""
+    
+    def test_admit_and_release(self):
+        """Test that an idle controller admits in the most complete mode"""
+        controller = AdmissionController()
+        mode = controller.admit(deadline=10.0, modes=("full", "direct"))
+        assert mode == "full"
+        assert controller.stats()["active"] == 1
+        
+        controller.release(mode, 2.0)
+        stats = controller.stats()
+        assert stats["active"] == 0
+        assert stats["admitted"] == 1
+        assert controller.service_time("full") == 2.0
+    
+    def test_downgrades_when_full_mode_too_slow(self):
+        """Test that a tight deadline picks the cheaper mode"""
+        controller = AdmissionController()
+        controller.release(controller.admit(), 8.0)
+        controller.release(controller.admit(modes=("direct",)), 1.0)
+        
+        mode = controller.admit(deadline=3.0, modes=("full", "direct"))
+        assert mode == "direct"
+        assert controller.stats()["downgraded"] == 1
+    
+    def test_unmeasured_modes_use_cost_prior(self):
+        """Test that cheaper modes are picked before they have ever run"""
+        controller = AdmissionController()
+        controller.release(controller.admit(), 10.0)
+        
+        assert controller.admit(deadline=4.0, modes=PIPELINE_MODES) == "direct"
+        controller.release("direct", 2.0)
+        assert controller.admit(deadline=1.0, modes=PIPELINE_MODES) == "template"
+        assert controller.service_time("direct") == 2.0
+    
+    def test_rejects_unmeetable_deadline(self):
+        """Test that requests that cannot meet their deadline are shed"""
+        controller = AdmissionController(initial_service_time=5.0)
+        with pytest.raises(AdmissionRejected):
+            controller.admit(deadline=1.0)
+        assert controller.stats()["shed"] == 1
+    
+    def test_rejects_when_queue_full(self):
+        """Test that a full queue sheds new requests"""
+        controller = AdmissionController(max_queue_depth=0)
+        with pytest.raises(AdmissionRejected) as exc_info:
+            controller.admit()
+        assert "full" in exc_info.value.reason
+    
+    def test_deadline_expires_while_queued(self):
+        """Test that a queued request is shed once its deadline passes"""
+        controller = AdmissionController(initial_service_time=0.01)
+        controller.admit()
+        
+        with pytest.raises(AdmissionRejected):
+            controller.admit(deadline=0.05)
+        stats = controller.stats()
+        assert stats["queue_depth"] == 0
+        assert stats["shed"] == 1
+    
+    def test_waiter_runs_after_release(self):
+        """Test that a queued request is admitted when a slot frees up"""
+        controller = AdmissionController()
+        controller.admit()
+        modes = []
+        waiter = threading.Thread(target=lambda: modes.append(controller.admit()))
+        waiter.start()
+        
+        controller.release("full", 0.1)
+        waiter.join(timeout=1.0)
+        assert modes == ["full"]
+
+    def admit_after_slow_release(self, controller, modes):
+        """Queue a request behind one that runs longer than estimated"""
+        controller.admit()
+        releaser = threading.Timer(0.25, controller.release, args=("full",))
+        releaser.start()
+        try:
+            return controller.admit(deadline=0.3, modes=modes)
+        finally:
+            releaser.join()
+    
+    def test_downgrades_when_queueing_ran_long(self):
+        """Test that the mode is re-picked against the time left after queueing"""
+        controller = AdmissionController()
+        controller.release(controller.admit(), 0.1)
+        controller.release(controller.admit(modes=("direct",)), 0.01)
+        
+        assert self.admit_after_slow_release(controller, ("full", "direct")) == "direct"
+    
+    def test_sheds_when_no_mode_fits_after_queueing(self):
+        """Test that a request left without enough time is shed instead of run"""
+        controller = AdmissionController()
+        controller.release(controller.admit(), 0.1)
+        
+        with pytest.raises(AdmissionRejected):
+            self.admit_after_slow_release(controller, ("full",))
+        stats = controller.stats()
+        assert stats["shed"] == 1
+        assert stats["active"] == 0
+        assert stats["queue_depth"] == 0
+    
+    def test_failed_release_keeps_service_time(self):
+        """Test that releasing without a duration does not update the estimate"""
+        controller = AdmissionController()
+        controller.release(controller.admit(), 2.0)
+        controller.release(controller.admit())
+        
+        assert controller.service_time("full") == 2.0
+        assert controller.stats()["active"] == 0
+
+class TestQueryHandlerSystemAdmission:
+    """Test QueryHandlerSystem behind admission control"""
+    
+    def test_process_query_reports_mode(self):
+        """Test that admitted requests are tagged with their mode"""
+        system = QueryHandlerSystem(model_name="test_model", admission=AdmissionController())
+        system.handler = Mock(return_value=make_result(), query_cache={})
+        
+        result = system.process_query("test query", deadline=10.0)
+        
+        assert result["mode"] == "full"
+        system.handler.assert_called_once_with("test query", mode="full")
+        assert system.admission.stats()["admitted"] == 1
+    
+    def test_handler_error_does_not_update_service_time(self):
+        """Test that failed handler calls free the slot without skewing the estimate"""
+        system = QueryHandlerSystem(model_name="test_model", admission=AdmissionController())
+        system.handler = Mock(side_effect=RuntimeError("LM unavailable"), query_cache={})
+        
+        with pytest.raises(RuntimeError):
+            system.process_query("test query")
+        
+        assert system.admission.service_time("full") == system.admission.initial_service_time
+        assert system.admission.stats()["active"] == 0
+    
+    def test_serves_cached_result_under_pressure(self):
+        """Test that a cached result is returned when the deadline cannot be met"""
+        admission = AdmissionController(initial_service_time=5.0)
+        system = QueryHandlerSystem(model_name="test_model", admission=admission)
+        system.handler = Mock(query_cache={"test query": make_result()})
+        
+        result = system.process_query("test query", deadline=1.0)
+        
+        assert result["mode"] == "cached"
+        system.handler.assert_not_called()
+        assert system.admission.stats()["downgraded"] == 1
@@ -0,0 +1,159 @@
+"""
+Tests for prompt-length budgeting and compression
+"""
+
+from unittest.mock import Mock
+from auto_prompt_generation.budget import apply_budget, compress_prompt, count_tokens
+from auto_prompt_generation.core import DynamicQueryHandler
+
+QUERY = "How do I implement a binary search tree in Python?"
+
+PROMPT = f"""You are a senior software engineer. You have 20 years of experience building data structures. You are known for clear explanations.
+
+Explain the implementation step by step. Include code examples. Explain the implementation step by step. Mention time complexity.
+
+User's question: {QUERY}
+
+User's question: {QUERY}"""
+
+class TestCountTokens:
+    """Test the local token estimate"""
+    
+    def test_counts_words_and_punctuation(self):
+        """Test that words and punctuation are counted"""
+        assert count_tokens("") == 0
+        assert count_tokens("Hello, world!") == 4
+    
+    def test_long_words_count_as_several_tokens(self):
+        """Test that long words are split into several tokens"""
+        assert count_tokens("internationalization") > 1
+
+class TestCompressPrompt:
+    """Test deterministic prompt compression"""
+    
+    def test_within_budget_is_unchanged(self):
+        """Test that prompts within budget are returned as is"""
+        prompt, before, after, truncated = compress_prompt(PROMPT, QUERY, 1000)
+        assert prompt == PROMPT
+        assert before == after == count_tokens(PROMPT)
+        assert not truncated
+    
+    def test_deduplicates_query(self):
+        """Test that the repeated query block is removed first"""
+        budget = count_tokens(PROMPT) - 5
+        prompt, before, after, truncated = compress_prompt(PROMPT, QUERY, budget)
+        
+        assert prompt.count(QUERY) == 1
+        assert "You have 20 years of experience" in prompt
+        assert before > after
+        assert after <= budget
+        assert not truncated
+    
+    def test_removes_redundant_instructions_and_persona_boilerplate(self):
+        """Test that repeated instructions and persona filler go before anything else"""
+        expected = (
+            "You are a senior software engineer.\n\n"
+            "Explain the implementation step by step. Include code examples. Mention time complexity.\n\n"
+            f"User's question: {QUERY}"
+        )
+        prompt, _, _, truncated = compress_prompt(PROMPT, QUERY, count_tokens(expected))
+        
+        assert prompt == expected
+        assert not truncated
+    
+    def test_keeps_persona_and_query_under_tiny_budget(self):
+        """Test that the persona opening and the query always survive"""
+        prompt, _, _, truncated = compress_prompt(PROMPT, QUERY, 1)
+        assert prompt == f"You are a senior software engineer.\n\nUser's question: {QUERY}"
+        assert truncated
+    
+    def test_keeps_query_with_blank_lines(self):
+        """Test that a multi-paragraph query, such as pasted code, is never cut"""
+        query = "Here is my code:\n\ndef f(x):\n    return x*2\n\nWhy does it fail on strings?"
+        prompt = (
+            "You are a senior Python engineer. Explain the root cause. Suggest a fix. Show corrected code.\n\n"
+            f"User's question: {query}"
+        )
+        
+        for budget in (40, 1):
+            compressed, _, _, _ = compress_prompt(prompt, query, budget)
+            assert compressed == f"You are a senior Python engineer.\n\nUser's question: {query}"
+        
+        quoted = f"You are a tutor. Read this question:\n\n{query}\n\nThen answer it. Be brief."
+        compressed, _, _, _ = compress_prompt(quoted, query, 1)
+        assert compressed == f"You are a tutor.\n\n{query}"
+    
+    def test_short_query_block_is_kept(self):
+        """Test that a short query found inside body words does not count as present"""
+        prompt = (
+            "You are a data scientist with deep statistics expertise. "
+            "Explain why each step matters and walk through the reasoning.\n\n"
+            "User's question: Why?"
+        )
+        compressed, _, _, _ = compress_prompt(prompt, "Why?", 30)
+        
+        assert compressed.endswith("User's question: Why?")
+    
+    def test_keeps_instructions_in_persona_paragraph(self):
+        """Test that a slightly over-budget prompt only loses persona filler"""
+        prompt = (
+            "You are a senior engineer. You have 20 years of experience. Follow these steps:\n"
+            "1. Read the code.\n"
+            "2. Write tests.\n\n"
+            f"User's question: {QUERY}"
+        )
+        compressed, _, _, _ = compress_prompt(prompt, QUERY, count_tokens(prompt) - 1)
+        
+        assert compressed == (
+            "You are a senior engineer. Follow these steps:\n"
+            "1. Read the code.\n"
+            "2. Write tests.\n\n"
+            f"User's question: {QUERY}"
+        )
+    
+    def test_preserves_line_breaks_of_untouched_paragraphs(self):
+        """Test that deduplicating the query leaves other paragraphs verbatim"""
+        steps = "Answer in three steps:\n1. Define the node.\n2. Implement insert.\n3. Implement search."
+        prompt = f"You are a tutor.\n\n{steps}\n\nUser's question: {QUERY}\n\nUser's question: {QUERY}"
+        compressed, _, _, _ = compress_prompt(prompt, QUERY, count_tokens(prompt) - 1)
+        
+        assert compressed == f"You are a tutor.\n\n{steps}\n\nUser's question: {QUERY}"
+    
+    def test_keeps_instructions_with_different_negation(self):
+        """Test that an instruction and its negation are not treated as repeats"""
+        prompt = (
+            "You are a tutor.\n\n"
+            "Do not include imports in your answer. Include imports in your answer. Be brief.\n\n"
+            f"User's question: {QUERY}"
+        )
+        compressed, _, _, _ = compress_prompt(prompt, QUERY, count_tokens(prompt) - 1)
+        
+        assert "Do not include imports in your answer." in compressed
+        assert "Include imports in your answer." in compressed
+    
+    def test_is_deterministic(self):
+        """Test that the same input always compresses the same way"""
+        assert compress_prompt(PROMPT, QUERY, 40) == compress_prompt(PROMPT, QUERY, 40)
+    
+    def test_apply_budget_without_limit(self):
+        """Test that no budget only reports the token count"""
+        prompt, before, after, truncated = apply_budget(PROMPT, QUERY, None)
+        assert prompt == PROMPT
+        assert before == after == count_tokens(PROMPT)
+        assert not truncated
+
+class TestHandlerBudget:
+    """Test the prompt budget in DynamicQueryHandler"""
+    
+    def test_forward_compresses_and_reports_tokens(self):
+        """Test that over-budget prompts are compressed with before/after counts"""
+        handler = DynamicQueryHandler(max_prompt_tokens=40)
+        handler.prompt_optimizer = Mock(return_value=Mock(optimized_prompt=PROMPT))
+        
+        result = handler.forward(QUERY, mode="direct")
+        
+        assert result.original_prompt_tokens == count_tokens(PROMPT)
+        assert result.prompt_tokens == count_tokens(result.optimized_prompt)
+        assert result.prompt_tokens < result.original_prompt_tokens
+        assert result.prompt_truncated
+        assert QUERY in result.optimized_prompt
@@ -2,14 +2,20 @@
 Tests for the core functionality
 """
 
+import sys
+import threading
 import pytest
+import dspy
 from unittest.mock import Mock, patch, MagicMock
 from auto_prompt_generation.core import (
+    SYSTEM_INSTRUCTION,
     QueryClassifier,
     ExpertPersonaGenerator,
     PromptOptimizer,
     DynamicQueryHandler,
-    QueryHandlerSystem
+    QueryHandlerSystem,
+    PrefixCachingAdapter,
+    LRUCache
 )
 
 class TestQueryHandlerSystem:
@@ -143,3 +149,163 @@ class TestPromptOptimizer:
         assert hasattr(PromptOptimizer, 'query_type')
         assert hasattr(PromptOptimizer, 'intent')
         assert hasattr(PromptOptimizer, 'optimized_prompt')
+
+class TestPrefixCachingAdapter:
+    """Test the shared static prompt prefix"""
+    
+    def test_preamble_leads_system_message(self):
+        """Test that the preamble is prepended to the system message"""
+        handler = DynamicQueryHandler()
+        predictor = handler.classifier.predictors()[0]
+        messages = handler.adapter.format(predictor.signature, [], {"query": "test query"})
+        
+        assert messages[0]["role"] == "system"
+        assert messages[0]["content"].startswith(SYSTEM_INSTRUCTION)
+        assert "test query" in messages[-1]["content"]
+        assert all("test query" not in m["content"] for m in messages[:-1])
+    
+    def test_shared_prefix_lengths(self):
+        """Test that every stage reports a static prefix covering the preamble"""
+        handler = DynamicQueryHandler()
+        lengths = handler.shared_prefix_lengths()
+        
+        assert set(lengths) == {"classifier", "persona_generator", "prompt_optimizer"}
+        assert all(length > len(SYSTEM_INSTRUCTION) for length in lengths.values())
+    
+    def test_forward_uses_adapter(self):
+        """Test that forward runs the pipeline under the prefix caching adapter"""
+        handler = DynamicQueryHandler()
+        
+        with patch.object(handler, '_run_pipeline') as mock_run:
+            mock_run.side_effect = lambda query, mode: dspy.settings.adapter
+            assert handler.forward("test query") is handler.adapter
+
+class TestLRUCache:
+    """Test the bounded caches used by DynamicQueryHandler"""
+    
+    def test_evicts_least_recently_used(self):
+        """Test that the oldest unused entry is evicted beyond max_size"""
+        cache = LRUCache(max_size=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        assert cache.get("a") == 1
+        cache["c"] = 3
+        
+        assert list(cache) == ["a", "c"]
+        assert cache.get("b") is None
+    
+    def test_handler_caches_are_bounded(self):
+        """Test that the handler caches honour cache_size"""
+        handler = DynamicQueryHandler(cache_size=3)
+        for i in range(10):
+            handler.query_cache[f"query {i}"] = i
+            handler.persona_cache[("technical", f"domain {i}", "simple")] = i
+        
+        assert len(handler.query_cache) == 3
+        assert len(handler.persona_cache) == 3
+    
+    def test_concurrent_get_and_set(self):
+        """Test that lookups racing with evictions miss instead of raising"""
+        cache = LRUCache(max_size=2)
+        errors = []
+        done = threading.Event()
+        
+        def write():
+            for i in range(20000):
+                cache[i % 4] = i
+            done.set()
+        
+        def read():
+            try:
+                while not done.is_set():
+                    for key in range(4):
+                        cache.get(key)
+            except Exception as exc:
+                errors.append(exc)
+        
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(2)]
+        # Switch threads often enough for a lookup to interleave with an eviction
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        
+        assert errors == []
+        assert len(cache) == 2
+
+class TestPipelineModes:
+    """Test the pipeline modes of DynamicQueryHandler"""
+    
+    def test_direct_mode_skips_analysis_stages(self):
+        """Test that direct mode only runs the prompt optimizer"""
+        handler = DynamicQueryHandler()
+        handler.classifier = Mock()
+        handler.persona_generator = Mock()
+        handler.prompt_optimizer = Mock(return_value=Mock(optimized_prompt="You are an expert. test query"))
+        
+        result = handler.forward("test query", mode="direct")
+        
+        handler.classifier.assert_not_called()
+        handler.persona_generator.assert_not_called()
+        assert result.optimized_prompt == "You are an expert. test query"
+        assert "test query" not in handler.query_cache
+    
+    def test_unknown_mode(self):
+        """Test that unknown modes are rejected"""
+        handler = DynamicQueryHandler()
+        with pytest.raises(ValueError):
+            handler.forward("test query", mode="bogus")
+    
+    def make_handler(self):
+        """Build a handler with mocked pipeline stages"""
+        handler = DynamicQueryHandler()
+        handler.classifier = Mock(signature=QueryClassifier, return_value=Mock(
+            query_type="technical",
+            domain="technology",
+            complexity="moderate",
+            intent="learn programming"
+        ))
+        handler.persona_generator = Mock(signature=ExpertPersonaGenerator, return_value=Mock(
+            expert_role="software engineer",
+            expertise_description="experienced developer"
+        ))
+        handler.prompt_optimizer = Mock(signature=PromptOptimizer, return_value=Mock(
+            optimized_prompt="You are a software engineer. test query"
+        ))
+        return handler
+    
+    def test_no_reasoning_mode_uses_base_signatures(self):
+        """Test that no_reasoning mode runs each stage without the reasoning field"""
+        handler = self.make_handler()
+        handler.forward("test query", mode="no_reasoning")
+        
+        for stage, signature in (
+            (handler.classifier, QueryClassifier),
+            (handler.persona_generator, ExpertPersonaGenerator),
+            (handler.prompt_optimizer, PromptOptimizer)
+        ):
+            assert stage.call_args.kwargs["new_signature"] is signature
+    
+    def test_cached_persona_mode_reuses_persona(self):
+        """Test that cached_persona mode skips persona generation for a known classification"""
+        handler = self.make_handler()
+        handler.forward("test query", mode="full")
+        handler.forward("another query", mode="cached_persona")
+        
+        assert handler.persona_generator.call_count == 1
+        assert handler.classifier.call_count == 2
+    
+    def test_template_mode_makes_no_lm_calls(self):
+        """Test that template mode builds the prompt without any stage"""
+        handler = self.make_handler()
+        result = handler.forward("test query", mode="template")
+        
+        handler.classifier.assert_not_called()
+        handler.prompt_optimizer.assert_not_called()
+        assert result.optimized_prompt.startswith("You are")
+        assert result.optimized_prompt.endswith("User's question: test query")
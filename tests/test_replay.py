@@ -0,0 +1,211 @@
+"""
+Tests for traffic recording and replay
+"""
+
+import json
+import time
+from unittest.mock import Mock
+import pytest
+import dspy
+from concurrent.futures import ThreadPoolExecutor
+from dspy.utils.callback import BaseCallback, with_callbacks
+from auto_prompt_generation.admission import AdmissionController, AdmissionRejected
+from auto_prompt_generation.core import QueryHandlerSystem
+from auto_prompt_generation.recording import TrafficRecorder, load_trace
+from auto_prompt_generation.replay import ReplayLM, replay, summarize
+
+FIELDS = {
+    "reasoning": "Because.",
+    "query_type": "technical",
+    "domain": "technology",
+    "complexity": "moderate",
+    "intent": "learn programming",
+    "expert_role": "software engineer",
+    "expertise_description": "experienced developer",
+    "optimized_prompt": "You are a software engineer. Answer: test query"
+}
+
+class FakeLM(dspy.LM):
+    """LM that answers every stage with all pipeline output fields"""
+    
+    def __init__(self, delay: float = 0.0):
+        super().__init__(model="fake")
+        self.calls = 0
+        self.delay = delay
+    
+    @with_callbacks
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        body = "".join(f"[[ ## {name} ## ]]\n{value}\n\n" for name, value in FIELDS.items())
+        return [body + "[[ ## completed ## ]]"]
+
+@pytest.fixture
+def trace_path(tmp_path):
+    """Record two queries with a fake LM and return the trace path"""
+    path = str(tmp_path / "trace.jsonl")
+    system = QueryHandlerSystem(lm=FakeLM(), recorder=TrafficRecorder(path))
+    system.process_query("test query")
+    system.process_query("another query")
+    return path
+
+class CountingCallback(BaseCallback):
+    """Callback counting LM calls"""
+    
+    def __init__(self):
+        self.lm_calls = 0
+    
+    def on_lm_start(self, call_id, instance, inputs):
+        self.lm_calls += 1
+
+class TestTrafficRecorder:
+    """Test the TrafficRecorder callback"""
+    
+    def test_records_one_line_per_query(self, trace_path):
+        """Test that each handler call is appended as one compact JSON line"""
+        with open(trace_path) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 2
+        assert all(json.loads(line) for line in lines)
+    
+    def test_records_stage_calls(self, trace_path):
+        """Test that LM calls are attributed to their pipeline stage"""
+        record = load_trace(trace_path)[0]
+        
+        assert record["query"] == "test query"
+        assert record["mode"] == "full"
+        assert record["duration"] >= 0
+        assert [call["stage"] for call in record["calls"]] == [
+            "classifier", "persona_generator", "prompt_optimizer"
+        ]
+        assert all(call["messages"] and call["outputs"] for call in record["calls"])
+    
+    def test_records_spike_from_arrival(self, tmp_path):
+        """Test that queued, shed and cached requests are traced from arrival"""
+        path = str(tmp_path / "trace.jsonl")
+        system = QueryHandlerSystem(
+            lm=FakeLM(delay=0.05),
+            recorder=TrafficRecorder(path),
+            admission=AdmissionController(max_concurrency=1, initial_service_time=0.15)
+        )
+        
+        def call(i):
+            try:
+                system.process_query(f"query {i}", deadline=0.5, priority=i % 2)
+            except AdmissionRejected:
+                pass
+        
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            list(executor.map(call, range(5)))
+        
+        records = load_trace(path)
+        assert len(records) == 5
+        assert records[-1]["time"] - records[0]["time"] < 0.1
+        assert all(record["deadline"] == 0.5 for record in records)
+        assert sorted(record["priority"] for record in records) == [0, 0, 0, 1, 1]
+        assert all(record["mode"] or record.get("rejected") for record in records)
+        assert any(record.get("rejected") for record in records)
+    
+    def test_keeps_existing_callbacks_and_scopes_recorder(self, tmp_path):
+        """Test that the recorder neither replaces user callbacks nor leaks into other systems"""
+        counter = CountingCallback()
+        path = str(tmp_path / "trace.jsonl")
+        dspy.settings.configure(callbacks=[counter])
+        try:
+            QueryHandlerSystem(lm=FakeLM(), recorder=TrafficRecorder(path)).process_query("test query")
+            assert counter.lm_calls == 3
+            
+            QueryHandlerSystem(lm=FakeLM()).process_query("another query")
+            assert counter.lm_calls == 6
+        finally:
+            dspy.settings.configure(callbacks=[])
+        
+        assert [record["query"] for record in load_trace(path)] == ["test query"]
+
+class TestReplay:
+    """Test replaying a recorded trace"""
+    
+    def test_stand_in_serves_recorded_responses(self, trace_path):
+        """Test that a replay against the stand-in LM reproduces every request"""
+        records = load_trace(trace_path)
+        system = QueryHandlerSystem(lm=ReplayLM(records, speed=100.0))
+        
+        results = replay(records, system, speed=100.0)
+        
+        assert [result["query"] for result in results] == ["test query", "another query"]
+        assert all("error" not in result and result["mode"] == "full" for result in results)
+        summary = summarize(results)
+        assert summary["requests"] == 2
+        assert summary["errors"] == 0
+    
+    def test_replay_passes_deadline_and_priority(self):
+        """Test that recorded deadlines (scaled by speed) and priorities are replayed"""
+        system = Mock()
+        system.process_query.return_value = {"mode": "full"}
+        records = [{"time": 0.0, "query": "test query", "deadline": 4.0, "priority": 2}]
+        
+        results = replay(records, system, speed=2.0)
+        
+        system.process_query.assert_called_once_with("test query", deadline=pytest.approx(2.0, abs=0.05), priority=2)
+        assert results[0]["mode"] == "full"
+    
+    def test_worker_queueing_counts_as_latency(self):
+        """Test that waiting for a replay worker shows up in the tail latencies"""
+        def process_query(query, deadline=None, priority=0):
+            time.sleep(0.05)
+            return {"mode": "full"}
+        
+        system = Mock()
+        system.process_query.side_effect = process_query
+        records = [{"time": 0.0, "query": f"query {i}"} for i in range(8)]
+        
+        summary = summarize(replay(records, system, max_workers=2))
+        
+        assert summary["p50"] >= 0.1
+        assert summary["p95"] >= 0.19
+    
+    def test_expired_deadline_is_rejected_before_dispatch(self):
+        """Test that a request whose deadline passes while waiting for a worker is shed"""
+        system = Mock()
+        system.process_query.side_effect = lambda query, **kwargs: time.sleep(0.1) or {"mode": "full"}
+        records = [{"time": 0.0, "query": f"query {i}", "deadline": 0.05} for i in range(2)]
+        
+        results = replay(records, system, max_workers=1)
+        
+        assert "mode" in results[0]
+        assert results[1]["rejected"] == "deadline expired before dispatch"
+        assert system.process_query.call_count == 1
+    
+    def test_stand_in_falls_back_per_stage_and_query(self):
+        """Test that a changed prompt is served the response recorded for its own query"""
+        system_message = {"role": "system", "content": "classify"}
+        records = [
+            {"query": query, "calls": [{
+                "messages": [system_message, {"role": "user", "content": f"old prompt: {query}"}],
+                "outputs": [f"answer to {query}"]
+            }]}
+            for query in ("test query", "another query", "test")
+        ]
+        lm = ReplayLM(records)
+        
+        for query in ("another query", "test query", "test"):
+            outputs = lm(messages=[system_message, {"role": "user", "content": f"new prompt: {query}"}])
+            assert outputs == [f"answer to {query}"]
+        with pytest.raises(LookupError):
+            lm(messages=[system_message, {"role": "user", "content": "unrecorded query"}])
+    
+    def test_stand_in_run_can_be_recorded(self, trace_path, tmp_path):
+        """Test that LM calls served by the stand-in reach the recorder"""
+        records = load_trace(trace_path)
+        path = str(tmp_path / "replayed.jsonl")
+        system = QueryHandlerSystem(lm=ReplayLM(records, speed=100.0), recorder=TrafficRecorder(path))
+        
+        system.process_query("test query")
+        
+        assert len(load_trace(path)[0]["calls"]) == 3
+    
+    def test_stand_in_rejects_unknown_prompt(self):
+        """Test that the stand-in LM fails loudly without a matching recording"""
+        lm = ReplayLM([])
+        with pytest.raises(LookupError):
+            lm(messages=[{"role": "system", "content": "unknown"}])